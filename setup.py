@@ -17,7 +17,8 @@ setup(name='undone',
                    'Programming Language :: Python :: 3.6',],
       keywords='undo redo undostack',
       packages=['undone',],
-      extras_require={'test': ['pytest'],},
+      extras_require={'test': ['pytest'],
+                      'persistent': ['pyrsistent'],},
       python_requires='>=2.7, != 3.0.*, != 3.1.*, != 3.2, <4',
       zip_safe=False,
       entry_points={})
@@ -1,7 +1,9 @@
 import collections
 import functools
+import pickle
 import pytest
 import undone
+import weakref
 
 INITIAL_STATE = [4]
 SECOND_STATE = [4, 1]
@@ -29,10 +31,10 @@ def common_tests(stack, resource, ops):
     with pytest.raises(IndexError):
         stack.redo()
     stack.undo()
-    assert stack.undone == [ops[1]]
+    assert list(stack.undone) == [ops[1]]
     stack.do(ops[2])
     assert resource() == FOURTH_STATE
-    assert stack.undone == []
+    assert not stack.undone
 
 def test_reversible():
     resource = []
@@ -81,14 +83,14 @@ def test_snapshot():
     stack.do()
     assert stack.clean
     assert stack.current_state == SECOND_STATE
-    assert stack.snapshots == [SECOND_STATE]
+    assert list(stack.snapshots) == [SECOND_STATE]
     stack.do(new_state=FIFTH_STATE)
     assert stack.current_state == FIFTH_STATE
     assert stack.snapshots[-1] == FIFTH_STATE
     stack.undo()
     assert stack.current_state == SECOND_STATE
-    assert stack.snapshots == [SECOND_STATE]
-    assert stack.forward_snapshots == [FIFTH_STATE]
+    assert list(stack.snapshots) == [SECOND_STATE]
+    assert list(stack.forward_snapshots) == [FIFTH_STATE]
     stack.undo()
     assert stack.current_state == INITIAL_STATE
     assert not stack.snapshots
@@ -97,23 +99,23 @@ def test_snapshot():
         stack.undo()
     stack.redo()
     assert stack.current_state == SECOND_STATE
-    assert stack.snapshots == [SECOND_STATE]
-    assert stack.forward_snapshots == [FIFTH_STATE]
+    assert list(stack.snapshots) == [SECOND_STATE]
+    assert list(stack.forward_snapshots) == [FIFTH_STATE]
     stack.redo()
     assert stack.current_state == FIFTH_STATE
-    assert stack.snapshots == [SECOND_STATE, FIFTH_STATE]
+    assert list(stack.snapshots) == [SECOND_STATE, FIFTH_STATE]
     assert not stack.forward_snapshots
     with pytest.raises(IndexError):
         stack.redo()
     stack.undo()
     assert stack.current_state == SECOND_STATE
-    assert stack.snapshots == [SECOND_STATE]
-    assert stack.forward_snapshots == [FIFTH_STATE]
+    assert list(stack.snapshots) == [SECOND_STATE]
+    assert list(stack.forward_snapshots) == [FIFTH_STATE]
     stack.current_state.extend([64, 256])
     del stack.current_state[1]
     stack.do()
     assert stack.current_state == SIXTH_STATE
-    assert stack.snapshots == [SECOND_STATE, SIXTH_STATE]
+    assert list(stack.snapshots) == [SECOND_STATE, SIXTH_STATE]
     assert not stack.forward_snapshots
     stack.current_state.append(1024)
     assert stack.current_state == SEVENTH_STATE
@@ -121,3 +123,537 @@ def test_snapshot():
     stack.discard_changes()
     assert stack.current_state == SIXTH_STATE
     assert stack.clean
+
+def test_fast_deepcopy():
+    original = {'a': [1, 2, {'b': (3, [4])}], 'c': {5, 6}, 'd': None}
+    clone = undone.undone._fast_deepcopy(original)
+    assert clone == original
+    assert clone is not original
+    assert clone['a'] is not original['a']
+    assert clone['a'][2]['b'][1] is not original['a'][2]['b'][1]
+    clone['a'][2]['b'][1].append(5)
+    assert original['a'][2]['b'][1] == [4]
+    fallback = collections.OrderedDict([('x', [1])])
+    fallback_clone = undone.undone._fast_deepcopy(fallback)
+    assert fallback_clone == fallback
+    assert fallback_clone['x'] is not fallback['x']
+
+def test_snapshot_copy_on_write():
+    stack = undone.SnapshotUndoStack([[1], [2]])
+    stack.current_state[0].append(3)
+    stack.do()
+    assert stack._current_state is not stack.snapshots[-1]
+    stack.undo()
+    stack.redo()
+    assert stack._current_state is stack.snapshots[-1]
+    stack.current_state[1].append(4)
+    assert stack.snapshots[-1] == [[1, 3], [2]]
+    assert not stack.clean
+    stack.do()
+    stack.undo()
+    assert stack._current_state is stack.snapshots[-1]
+    stack.current_state[0].append(5)
+    assert stack.snapshots[-1] == [[1, 3], [2]]
+    assert stack.forward_snapshots[-1] == [[1, 3], [2, 4]]
+    stack.undo()
+    stack.current_state.append(6)
+    assert stack.initial_state == [[1], [2]]
+
+def test_snapshot_held_reference():
+    stack = undone.SnapshotUndoStack([0])
+    ref = stack.current_state
+    ref.append(1)
+    stack.do()
+    ref.append(2)
+    stack.do()
+    assert list(stack.snapshots) == [[0, 1], [0, 1, 2]]
+    assert stack.current_state is ref
+    stack.undo()
+    assert stack.current_state == [0, 1]
+
+def test_snapshot_discard_clean_keeps_reference():
+    stack = undone.SnapshotUndoStack([0])
+    stack.current_state.append(1)
+    stack.do()
+    ref = stack.current_state
+    stack.discard_changes()
+    ref.append(2)
+    assert stack.current_state is ref
+    assert stack.current_state == [0, 1, 2]
+    assert list(stack.snapshots) == [[0, 1]]
+
+def test_snapshot_persistent_backend():
+    pyrsistent = pytest.importorskip('pyrsistent')
+    stack = undone.SnapshotUndoStack(INITIAL_STATE, backend='persistent')
+    assert isinstance(stack.current_state, pyrsistent.PVector)
+    stack.do(stack.current_state.append(1))
+    assert stack.current_state == SECOND_STATE
+    assert stack.current_state is stack.snapshots[-1]
+    stack.current_state = stack.current_state.set(1, 2)
+    assert not stack.clean
+    stack.do()
+    assert list(stack.snapshots) == [SECOND_STATE, [4, 2]]
+    stack.undo()
+    assert stack.current_state == SECOND_STATE
+    stack.undo()
+    assert stack.current_state == INITIAL_STATE
+    stack.redo()
+    assert stack.current_state == SECOND_STATE
+    stack.do(FIFTH_STATE)
+    assert isinstance(stack.current_state, pyrsistent.PVector)
+    assert stack.clean
+    assert not stack.forward_snapshots
+
+def test_snapshot_persistent_backend_immutable_input():
+    pyrsistent = pytest.importorskip('pyrsistent')
+    stack = undone.SnapshotUndoStack((1, 2), backend='persistent')
+    assert isinstance(stack.current_state, pyrsistent.PVector)
+    stack.do(stack.current_state.append(3))
+    stack.do(new_state=(4, 5))
+    assert isinstance(stack.current_state, pyrsistent.PVector)
+    stack.undo()
+    assert stack.current_state == [1, 2, 3]
+
+def test_snapshot_unknown_backend():
+    with pytest.raises(ValueError):
+        undone.SnapshotUndoStack(INITIAL_STATE, backend='unknown')
+
+def test_snapshot_diff():
+    stack = undone.SnapshotUndoStack(INITIAL_STATE, diff=True)
+    stack.current_state.append(1)
+    stack.do()
+    assert list(stack.snapshots) == [('list', 1, [], [1])]
+    stack.do(new_state=FIFTH_STATE)
+    stack.undo()
+    assert stack.current_state == SECOND_STATE
+    stack.current_state.extend([64, 256])
+    del stack.current_state[1]
+    stack.do()
+    assert stack.snapshots[-1] == ('list', 1, [1], [64, 256])
+    assert stack.current_state == SIXTH_STATE
+    stack.undo()
+    assert stack.current_state == SECOND_STATE
+    stack.undo()
+    assert stack.current_state == INITIAL_STATE
+    assert stack.initial_state == INITIAL_STATE
+    stack.redo()
+    stack.redo()
+    assert stack.current_state == SIXTH_STATE
+    assert stack.clean
+    stack.do(new_state={'a': [1], 'b': 2})
+    stack.current_state['a'].append(3)
+    del stack.current_state['b']
+    stack.current_state['c'] = 4
+    stack.do()
+    assert stack.snapshots[-1] == ('dict', {'a': ([1], [1, 3]),
+                                            'b': (2, undone.undone._MISSING),
+                                            'c': (undone.undone._MISSING, 4)})
+    stack.undo()
+    assert stack.current_state == {'a': [1], 'b': 2}
+    stack.undo()
+    assert stack.current_state == SIXTH_STATE
+    stack.redo()
+    stack.redo()
+    assert stack.current_state == {'a': [1, 3], 'c': 4}
+
+def test_regenerating_checkpoints():
+    calls = []
+    def add(n, r):
+        calls.append(n)
+        r.append(n)
+    stack = undone.RegeneratingUndoStack([], checkpoint_interval=3)
+    for n in range(7):
+        stack.do(functools.partial(add, n))
+    assert [idx for idx, _ in stack._checkpoints] == [3, 6]
+    del calls[:]
+    stack.undo()
+    assert stack.current_state == [0, 1, 2, 3, 4, 5]
+    assert calls == []
+    stack.undo()
+    assert stack.current_state == [0, 1, 2, 3, 4]
+    assert calls == [3, 4]
+    assert [idx for idx, _ in stack._checkpoints] == [3]
+    stack.redo()
+    stack.redo()
+    assert [idx for idx, _ in stack._checkpoints] == [3, 6]
+    stack.current_state.append('x')
+    assert stack._checkpoints[-1][1] == [0, 1, 2, 3, 4, 5]
+    for _ in range(7):
+        stack.undo()
+    assert stack.current_state == []
+    assert not stack._checkpoints
+
+def test_regenerating_inverse_ops():
+    class Append(object):
+        def __init__(self, value):
+            self.value = value
+        def __call__(self, r):
+            r.append(self.value)
+        def undo(self, r):
+            r.pop()
+    stack = undone.RegeneratingUndoStack(INITIAL_STATE)
+    def resource(s):
+        return s.current_state
+    common_tests(stack,
+                 functools.partial(resource, s=stack),
+                 [Append(1), Append(1), Append(2)])
+    state = stack.current_state
+    stack.undo()
+    assert stack.current_state is state
+    assert state == SECOND_STATE
+
+def test_initial_state_shared_until_accessed():
+    stack = undone.RegeneratingUndoStack(INITIAL_STATE)
+    assert stack._current_state is stack.initial_state
+    stack.do(lambda r: r.append(1))
+    assert stack.initial_state == INITIAL_STATE
+    stack.undo()
+    assert stack._current_state is stack.initial_state
+    stack = undone.SnapshotUndoStack(INITIAL_STATE)
+    assert stack._current_state is stack.initial_state
+    stack.current_state.append(1)
+    assert stack.initial_state == INITIAL_STATE
+
+@pytest.mark.parametrize('diff', [False, True])
+def test_snapshot_max_history(diff):
+    stack = undone.SnapshotUndoStack(INITIAL_STATE, diff=diff, max_history=2)
+    for state in [SECOND_STATE, THIRD_STATE, FOURTH_STATE]:
+        stack.do(new_state=list(state))
+    assert len(stack.snapshots) == 2
+    assert stack.initial_state == SECOND_STATE
+    stack.undo()
+    assert stack.current_state == THIRD_STATE
+    stack.undo()
+    assert stack.current_state == SECOND_STATE
+    with pytest.raises(IndexError):
+        stack.undo()
+    stack.redo()
+    stack.redo()
+    assert stack.current_state == FOURTH_STATE
+    with pytest.raises(ValueError):
+        undone.SnapshotUndoStack(INITIAL_STATE, max_history=0)
+
+def test_no_instance_dict():
+    stacks = [undone.ReversibleUndoStack(),
+              undone.RegeneratingUndoStack(INITIAL_STATE),
+              undone.SnapshotUndoStack(INITIAL_STATE)]
+    for stack in stacks:
+        assert not hasattr(stack, '__dict__')
+        assert weakref.ref(stack)() is stack
+
+def test_snapshot_serialized():
+    stack = undone.SnapshotUndoStack(INITIAL_STATE,
+                                     max_history=2,
+                                     serialize=pickle.dumps,
+                                     deserialize=pickle.loads)
+    stack.current_state.append(1)
+    stack.do()
+    assert list(stack.snapshots) == [pickle.dumps(SECOND_STATE)]
+    stack.current_state.append(1)
+    stack.do()
+    stack.do(new_state=list(FIFTH_STATE))
+    assert stack.initial_state == SECOND_STATE
+    stack.current_state.append('!')
+    assert not stack.clean
+    stack.undo()
+    assert stack.current_state == THIRD_STATE
+    stack.undo()
+    assert stack.current_state == SECOND_STATE
+    stack.redo()
+    stack.redo()
+    assert stack.current_state == FIFTH_STATE
+    assert stack.clean
+    with pytest.raises(ValueError):
+        undone.SnapshotUndoStack(INITIAL_STATE, serialize=pickle.dumps)
+    with pytest.raises(ValueError):
+        undone.SnapshotUndoStack(INITIAL_STATE,
+                                 diff=True,
+                                 serialize=pickle.dumps,
+                                 deserialize=pickle.loads)
+
+def test_snapshot_lazy_state():
+    stack = undone.SnapshotUndoStack([[1], 2])
+    stack.do()
+    view = stack.lazy_state
+    assert view == [[1], 2]
+    assert len(view) == 2
+    assert view[0] == [1]
+    assert 2 in view
+    assert list(view) == [[1], 2]
+    assert view.index(2) == 1
+    assert stack._cow_shared
+    view.append(3)
+    assert not stack._cow_shared
+    view[0] = 0
+    assert stack.current_state == [0, 2, 3]
+    assert stack.snapshots[-1] == [[1], 2]
+    assert not stack.clean
+    stack.discard_changes()
+    assert view == [[1], 2]
+    stack = undone.SnapshotUndoStack({1, 2})
+    stack.do()
+    stack.lazy_state.difference_update({1})
+    assert stack.snapshots[-1] == {1, 2}
+    assert stack.current_state == {2}
+    assert not stack.clean
+
+def test_is_immutable():
+    is_immutable = undone.undone._is_immutable
+    assert is_immutable(1)
+    assert is_immutable(None)
+    assert is_immutable((1, 'a', (2.0, frozenset([b'b']))))
+    assert not is_immutable((1, [2]))
+    assert not is_immutable([1])
+    assert not is_immutable(tuple(range(10)), limit=5)
+    state = (1, (2, 3))
+    stack = undone.SnapshotUndoStack(state)
+    assert stack.initial_state is state
+
+def test_snapshot_clean_versions():
+    class Counted(list):
+        comparisons = 0
+        def __eq__(self, other):
+            Counted.comparisons += 1
+            return list.__eq__(self, other)
+    stack = undone.SnapshotUndoStack(Counted([1]))
+    assert stack.clean
+    stack.current_state.append(2)
+    assert not stack.clean
+    assert Counted.comparisons == 1
+    stack.do()
+    assert stack.clean
+    assert Counted.comparisons == 2
+    stack.undo()
+    assert stack.clean
+    stack.redo()
+    assert stack.lazy_state == [1, 2]
+    assert stack.clean
+    stack.do()
+    assert stack.clean
+    assert Counted.comparisons == 3
+    stack.do(new_state=Counted([3]))
+    assert stack.clean
+    assert Counted.comparisons == 4
+
+def test_regenerating_numpy():
+    np = pytest.importorskip('numpy')
+    def increment(a):
+        a += 1
+    initial = np.zeros(4)
+    stack = undone.RegeneratingUndoStack(initial, checkpoint_interval=2)
+    buffer = stack.current_state
+    for _ in range(3):
+        stack.do(increment)
+    assert (buffer == 3).all()
+    stack.undo()
+    assert stack.current_state is buffer
+    assert (buffer == 2).all()
+    stack.undo()
+    stack.undo()
+    assert (buffer == 0).all()
+    assert (initial == 0).all()
+    stack.redo()
+    assert (stack.current_state == 1).all()
+
+@pytest.mark.parametrize('kwargs', [{},
+                                    {'diff': True},
+                                    {'serialize': pickle.dumps,
+                                     'deserialize': pickle.loads}])
+def test_snapshot_batch(kwargs):
+    stack = undone.SnapshotUndoStack(INITIAL_STATE, **kwargs)
+    for state in [SECOND_STATE, THIRD_STATE, FOURTH_STATE]:
+        stack.do(new_state=list(state))
+    with pytest.raises(IndexError):
+        stack.undo(4)
+    with pytest.raises(ValueError):
+        stack.undo(0)
+    assert stack.current_state == FOURTH_STATE
+    stack.undo(2)
+    assert stack.current_state == SECOND_STATE
+    assert len(stack.forward_snapshots) == 2
+    stack.undo()
+    assert stack.current_state == INITIAL_STATE
+    with pytest.raises(IndexError):
+        stack.redo(4)
+    stack.redo(3)
+    assert stack.current_state == FOURTH_STATE
+    assert stack.clean
+
+def test_regenerating_batch():
+    calls = []
+    def add(n, r):
+        calls.append(n)
+        r.append(n)
+    class Append(object):
+        def __init__(self, value):
+            self.value = value
+        def __call__(self, r):
+            r.append(self.value)
+        def undo(self, r):
+            r.pop()
+    stack = undone.RegeneratingUndoStack([])
+    for n in range(3):
+        stack.do(functools.partial(add, n))
+    stack.do(Append(3))
+    stack.do(Append(4))
+    del calls[:]
+    stack.undo(2)
+    assert stack.current_state == [0, 1, 2]
+    assert calls == []
+    stack.redo(2)
+    stack.undo(4)
+    assert stack.current_state == [0]
+    assert calls == [0]
+    with pytest.raises(IndexError):
+        stack.undo(2)
+    stack.redo(4)
+    assert stack.current_state == [0, 1, 2, 3, 4]
+
+def test_fast_deepcopy_buffers():
+    fast_deepcopy = undone.undone._fast_deepcopy
+    original = [bytearray(b'abc')]
+    clone = fast_deepcopy(original)
+    clone[0][0] = ord('x')
+    assert original == [bytearray(b'abc')]
+    np = pytest.importorskip('numpy')
+    array = np.arange(4)
+    array_clone = fast_deepcopy(array)
+    array_clone[0] = 9
+    assert array[0] == 0
+    objects = np.empty(2, dtype=object)
+    objects[0], objects[1] = [1], [2]
+    objects_clone = fast_deepcopy(objects)
+    objects_clone[0].append(3)
+    assert objects[0] == [1]
+
+def test_undo_stack_is_abstract():
+    with pytest.raises(TypeError):
+        undone.UndoStack()
+    class Incomplete(undone.UndoStack):
+        def do(self, op):
+            pass
+    with pytest.raises(TypeError):
+        Incomplete()
+    for cls in [undone.ReversibleUndoStack,
+                undone.RegeneratingUndoStack,
+                undone.SnapshotUndoStack]:
+        assert issubclass(cls, undone.UndoStack)
+
+def test_fast_deepcopy_aliases_and_cycles():
+    fast_deepcopy = undone.undone._fast_deepcopy
+    shared = [1]
+    clone = fast_deepcopy([shared, shared, (shared,)])
+    assert clone[0] is clone[1]
+    assert clone[2][0] is clone[0]
+    assert clone[0] is not shared
+    cycle = []
+    cycle.append(cycle)
+    cycle_clone = fast_deepcopy(cycle)
+    assert cycle_clone[0] is cycle_clone
+    assert cycle_clone is not cycle
+    looped = {'self': None}
+    looped['self'] = (looped, [looped])
+    looped_clone = fast_deepcopy(looped)
+    assert looped_clone['self'][0] is looped_clone
+    assert looped_clone['self'][1][0] is looped_clone
+    stack = undone.SnapshotUndoStack(cycle)
+    assert stack.current_state[0] is stack.current_state
+    immutable = (1, ('a', 2.0))
+    assert fast_deepcopy(immutable) is immutable
+
+def test_public_names():
+    namespace = {}
+    exec('from undone import *', namespace)
+    assert sorted(k for k in namespace if k != '__builtins__') == [
+        'RegeneratingUndoStack', 'ReversibleUndoStack', 'SnapshotUndoStack',
+        'UndoStack']
+
+@pytest.mark.parametrize('old, new', [(1, True), (1, 1.0), (0.0, -0.0)])
+def test_snapshot_diff_type_changes(old, new):
+    stack = undone.SnapshotUndoStack([old], diff=True)
+    stack.current_state[0] = new
+    stack.do()
+    assert type(stack.current_state[0]) is type(new)
+    stack.undo()
+    assert repr(stack.current_state[0]) == repr(old)
+    stack.redo()
+    assert repr(stack.current_state[0]) == repr(new)
+    stack.do(new_state={'k': old})
+    stack.current_state['k'] = new
+    stack.do()
+    stack.undo()
+    assert repr(stack.current_state['k']) == repr(old)
+    stack.do(new_state=[[old], {'a': [old]}, {old}])
+    stack.current_state[0][0] = new
+    stack.current_state[1]['a'][0] = new
+    stack.current_state[2] = {new}
+    stack.do()
+    stack.undo()
+    assert repr(stack.current_state) == repr([[old], {'a': [old]}, {old}])
+    stack.redo()
+    assert repr(stack.current_state) == repr([[new], {'a': [new]}, {new}])
+
+def test_regenerating_checkpoint_keeps_reference():
+    stack = undone.RegeneratingUndoStack([], checkpoint_interval=2)
+    ref = stack.current_state
+    for n in range(3):
+        stack.do(lambda r, n=n: r.append(n))
+    assert stack.current_state is ref
+    assert ref == [0, 1, 2]
+    assert stack._checkpoints[-1][1] == [0, 1]
+
+def test_regenerating_masked_array():
+    np = pytest.importorskip('numpy')
+    def unmask(a):
+        a.mask = np.ma.nomask
+    initial = np.ma.masked_array([1, 2, 3], mask=[True, False, True])
+    stack = undone.RegeneratingUndoStack(initial)
+    stack.do(unmask)
+    assert not stack.current_state.mask.any()
+    stack.undo()
+    assert list(stack.current_state.mask) == [True, False, True]
+
+def test_numpy_copies_keep_layout():
+    np = pytest.importorskip('numpy')
+    def increment(a):
+        a += 1
+    fortran = np.asfortranarray(np.zeros((3, 2)))
+    assert undone.undone._fast_deepcopy(fortran).flags.f_contiguous
+    stack = undone.RegeneratingUndoStack(fortran, checkpoint_interval=1)
+    assert stack.initial_state.flags.f_contiguous
+    assert stack.current_state.flags.f_contiguous
+    stack.do(increment)
+    assert stack._checkpoints[-1][1].flags.f_contiguous
+
+def test_snapshot_diff_numpy_elements():
+    np = pytest.importorskip('numpy')
+    stack = undone.SnapshotUndoStack([np.zeros(3), np.ones(3)], diff=True)
+    stack.current_state[1] = np.full(3, 2.0)
+    stack.do()
+    stack.undo()
+    assert (stack.current_state[0] == 0).all()
+    assert (stack.current_state[1] == 1).all()
+    stack.redo()
+    assert (stack.current_state[1] == 2).all()
+
+def test_regenerating_checkpoint_interval_validation():
+    for interval in [-1, 1.5, '2', True]:
+        with pytest.raises(ValueError):
+            undone.RegeneratingUndoStack([], checkpoint_interval=interval)
+    for interval in [None, 0]:
+        stack = undone.RegeneratingUndoStack([], checkpoint_interval=interval)
+        for n in range(3):
+            stack.do(lambda r, n=n: r.append(n))
+        assert not stack._checkpoints
+
+def test_regenerating_object_array():
+    np = pytest.importorskip('numpy')
+    initial = np.empty(2, dtype=object)
+    initial[0], initial[1] = [1], [2]
+    stack = undone.RegeneratingUndoStack(initial)
+    stack.do(lambda a: a[0].append(9))
+    assert stack.current_state[0] == [1, 9]
+    assert initial[0] == [1]
+    assert stack.initial_state[0] == [1]
+    stack.undo()
+    assert stack.current_state[0] == [1]
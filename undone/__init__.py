@@ -1,2 +1,3 @@
 from __future__ import absolute_import
 from undone.undone import *
+from undone.undone import __all__
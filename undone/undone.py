@@ -1,8 +1,339 @@
-import copy
+import abc
+import collections
+import itertools
+import math
+import numbers
+from copy import deepcopy as _deepcopy
 
-class UndoStack:
-    """Abstract parent class for undo stacks."""
-    pass
+__all__ = ['UndoStack', 'ReversibleUndoStack', 'RegeneratingUndoStack',
+           'SnapshotUndoStack']
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyrsistent
+except ImportError:
+    pyrsistent = None
+
+_MISSING = object()
+
+def _fast_deepcopy(obj, memo=None):
+    """Returns a deep copy of `obj`, specialized for plain data.
+    
+    Builtin containers are rebuilt recursively and atomic values are returned
+    as-is, which is much cheaper than the generic `copy.deepcopy` machinery.
+    Bytearrays and NumPy arrays are copied with a single buffer copy. Any
+    other type is handed off to `copy.deepcopy`.
+    
+    As with `copy.deepcopy`, a memo keyed on `id()` is kept, so objects
+    referenced more than once within `obj` are copied only once, and cyclic
+    structures are supported.
+    
+    Arguments:
+        obj: object to copy
+        memo (dict): objects already copied, as passed to `copy.deepcopy`
+    """
+    handler = _COPY_DISPATCH.get(type(obj))
+    if handler is _copy_atomic:
+        return obj
+    if memo is None:
+        memo = {}
+    else:
+        copied = memo.get(id(obj), _MISSING)
+        if copied is not _MISSING:
+            return copied
+    if handler is None:
+        return _deepcopy(obj, memo)
+    return handler(obj, memo)
+
+def _copy_atomic(obj, memo=None):
+    return obj
+
+def _copy_list(obj, memo):
+    copied = []
+    memo[id(obj)] = copied
+    copied.extend([_fast_deepcopy(x, memo) for x in obj])
+    return copied
+
+def _copy_dict(obj, memo):
+    copied = {}
+    memo[id(obj)] = copied
+    for k, v in obj.items():
+        copied[_fast_deepcopy(k, memo)] = _fast_deepcopy(v, memo)
+    return copied
+
+def _copy_tuple(obj, memo):
+    items = [_fast_deepcopy(x, memo) for x in obj]
+    # a cycle through the tuple may already have copied it
+    copied = memo.get(id(obj), _MISSING)
+    if copied is not _MISSING:
+        return copied
+    if all(a is b for a, b in zip(items, obj)):
+        copied = obj
+    else:
+        copied = tuple(items)
+    memo[id(obj)] = copied
+    return copied
+
+def _copy_set(obj, memo):
+    copied = set()
+    memo[id(obj)] = copied
+    copied.update([_fast_deepcopy(x, memo) for x in obj])
+    return copied
+
+def _copy_bytearray(obj, memo):
+    copied = bytearray(obj)
+    memo[id(obj)] = copied
+    return copied
+
+def _copy_ndarray(obj, memo):
+    # object arrays hold references, which must be copied too
+    if obj.dtype.hasobject:
+        return _deepcopy(obj, memo)
+    copied = obj.copy(order='K')
+    memo[id(obj)] = copied
+    return copied
+
+_ATOMIC_TYPES = frozenset([int, float, complex, bool, str, bytes,
+                           type(None)])
+
+_COPY_DISPATCH = {list: _copy_list,
+                  dict: _copy_dict,
+                  tuple: _copy_tuple,
+                  set: _copy_set,
+                  frozenset: _copy_atomic,
+                  bytearray: _copy_bytearray,}
+_COPY_DISPATCH.update(dict.fromkeys(_ATOMIC_TYPES, _copy_atomic))
+if np is not None:
+    _COPY_DISPATCH[np.ndarray] = _copy_ndarray
+
+def _is_immutable(obj, limit=1000):
+    """Checks cheaply whether `obj` is certainly immutable.
+    
+    Atomic values are immutable, as are tuples and frozensets containing only
+    immutable values. To keep the check cheap, gives up (returning False)
+    after examining `limit` objects.
+    
+    Returns:
+        bool: True if `obj` is known to be immutable, else False
+    """
+    pending = [obj]
+    while pending:
+        if limit <= 0:
+            return False
+        limit -= 1
+        item = pending.pop()
+        kind = type(item)
+        if kind is tuple or kind is frozenset:
+            pending.extend(item)
+        elif kind not in _ATOMIC_TYPES:
+            return False
+    return True
+
+def _freeze(obj):
+    """Converts `obj` to its persistent (immutable) equivalent, if needed.
+    
+    `pyrsistent.freeze` leaves tuples as they are, so an outermost tuple is
+    converted to a vector here, to give it the same structural sharing.
+    """
+    if isinstance(obj, (pyrsistent.PVector, pyrsistent.PMap, pyrsistent.PSet)):
+        return obj
+    if type(obj) is tuple:
+        return pyrsistent.pvector(pyrsistent.freeze(x) for x in obj)
+    return pyrsistent.freeze(obj)
+
+def _check_steps(n, stack):
+    """Checks that `n` entries can be popped from `stack`.
+    
+    Raises:
+        ValueError: if `n` is less than 1
+        IndexError: if `stack` holds fewer than `n` entries
+    """
+    if n < 1:
+        raise ValueError('number of steps must be at least 1')
+    if n > len(stack):
+        raise IndexError('cannot take {} steps; only {} '
+                         'available'.format(n, len(stack)))
+
+def _same(a, b):
+    """Checks whether `a` and `b` are interchangeable within a state.
+    
+    Equal values of different types (e.g. 1 and True), or floats of different
+    signs, still count as different, including within lists, tuples, dicts,
+    and sets. Values whose comparison doesn't give a single truth value count
+    as different.
+    """
+    if a is b:
+        return True
+    kind = type(a)
+    if kind is not type(b):
+        return False
+    if kind is float:
+        # 0.0 == -0.0, but the sign is still a change
+        return a == b and math.copysign(1.0, a) == math.copysign(1.0, b)
+    if kind is list or kind is tuple:
+        return len(a) == len(b) and all(map(_same, a, b))
+    if kind is dict:
+        return (len(a) == len(b)
+                and all(key in b and _same(value, b[key])
+                        for key, value in a.items()))
+    if kind is set or kind is frozenset:
+        return _typed(a) == _typed(b)
+    try:
+        # some types (e.g. NumPy arrays) don't compare to a single bool
+        return bool(a == b)
+    except (ValueError, TypeError):
+        return False
+
+def _typed(items):
+    return {(type(x), math.copysign(1.0, x) if type(x) is float else 0, x)
+            for x in items}
+
+def _diff(old, new):
+    """Returns an invertible delta which turns `old` into `new`.
+    
+    Lists are diffed by trimming their common prefix and suffix, so the delta
+    holds only the slice that differs. Dicts are diffed key by key. Anything
+    else is recorded as a wholesale replacement. Deltas only describe changes
+    to the outermost container, and hold references to (not copies of) its
+    elements.
+    
+    Returns:
+        None if `old` is `new`, else a tuple whose first item is its kind
+    """
+    if old is new:
+        return None
+    if type(old) is list and type(new) is list:
+        n_old, n_new = len(old), len(new)
+        limit = min(n_old, n_new)
+        start = 0
+        while start < limit and _same(old[start], new[start]):
+            start += 1
+        end = 0
+        while (end < limit - start
+               and _same(old[n_old - 1 - end], new[n_new - 1 - end])):
+            end += 1
+        return ('list', start, old[start:n_old - end], new[start:n_new - end])
+    if type(old) is dict and type(new) is dict:
+        changes = {}
+        for key, old_value in old.items():
+            new_value = new.get(key, _MISSING)
+            if new_value is _MISSING or not _same(old_value, new_value):
+                changes[key] = (old_value, new_value)
+        for key, new_value in new.items():
+            if key not in old:
+                changes[key] = (_MISSING, new_value)
+        return ('dict', changes)
+    # `new` will go on to be patched in place, so the delta needs its own copy
+    return ('replace', old, _fast_deepcopy(new))
+
+def _apply_delta(state, delta, reverse=False):
+    """Applies a delta from `_diff` to `state`, in place where possible.
+    
+    Arguments:
+        state: object the delta was taken from (or, if `reverse`, to)
+        delta: delta returned by `_diff`
+        reverse (bool): whether to undo the delta rather than apply it
+    
+    Returns:
+        the updated state, which is `state` itself unless it was replaced
+    """
+    if delta is None:
+        return state
+    kind = delta[0]
+    if kind == 'list':
+        _, start, old, new = delta
+        if reverse:
+            old, new = new, old
+        state[start:start + len(old)] = new
+    elif kind == 'dict':
+        for key, (old_value, new_value) in delta[1].items():
+            if reverse:
+                new_value = old_value
+            if new_value is _MISSING:
+                del state[key]
+            else:
+                state[key] = new_value
+    else:
+        state = _fast_deepcopy(delta[1] if reverse else delta[2])
+    return state
+
+class _LazyCopy(object):
+    """Proxy for a stack's `current_state` which is copied only when changed.
+    
+    Item access and a fixed set of known read-only methods are forwarded to
+    the state as it stands, even if it is still shared with a snapshot. Any
+    other attribute instead goes through the stack's `current_state` property,
+    which copies the state first if it is shared. Objects obtained through the
+    proxy must not be modified in place.
+    """
+    __slots__ = ('_stack',)
+    _READERS = frozenset(['copy', 'count', 'index', 'get', 'keys', 'values',
+                          'items', 'isdisjoint', 'issubset', 'issuperset',
+                          'union', 'intersection', 'difference',
+                          'symmetric_difference'])
+    
+    def __init__(self, stack):
+        self._stack = stack
+    
+    def __getattr__(self, name):
+        if name in self._READERS:
+            return getattr(self._stack._current_state, name)
+        return getattr(self._stack.current_state, name)
+    
+    def __getitem__(self, key):
+        return self._stack._current_state[key]
+    
+    def __setitem__(self, key, value):
+        self._stack.current_state[key] = value
+    
+    def __delitem__(self, key):
+        del self._stack.current_state[key]
+    
+    def __iter__(self):
+        return iter(self._stack._current_state)
+    
+    def __len__(self):
+        return len(self._stack._current_state)
+    
+    def __contains__(self, item):
+        return item in self._stack._current_state
+    
+    def __eq__(self, other):
+        return self._stack._current_state == other
+    
+    def __ne__(self, other):
+        return self._stack._current_state != other
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return repr(self._stack._current_state)
+
+# equivalent to abc.ABC, which Python 2 lacks
+_ABC = abc.ABCMeta('_ABC', (object,), {'__slots__': ()})
+
+class UndoStack(_ABC):
+    """Abstract parent class for undo stacks.
+    
+    Subclasses must implement `do`, `undo`, and `redo`.
+    """
+    __slots__ = ('__weakref__',)
+    
+    @abc.abstractmethod
+    def do(self, *args, **kwargs):
+        """Records a change on the undo stack, erasing the redo stack."""
+    
+    @abc.abstractmethod
+    def undo(self, *args, **kwargs):
+        """Reverts the last change on the undo stack."""
+    
+    @abc.abstractmethod
+    def redo(self, *args, **kwargs):
+        """Re-applies the last change on the redo stack."""
 
 class ReversibleUndoStack(UndoStack):
     """Undo stack for reversible operations.
@@ -28,9 +359,11 @@ class ReversibleUndoStack(UndoStack):
     If it is impossible or inconvenient to express the operations you need in a
     reversible form, use another type of undo stack.
     """
+    __slots__ = ('done', 'undone')
+    
     def __init__(self):
-        self.done = []
-        self.undone = []
+        self.done = collections.deque()
+        self.undone = collections.deque()
     
     def do(self, op):
         """Adds `op` to undo stack and applies it.
@@ -41,7 +374,8 @@ class ReversibleUndoStack(UndoStack):
             op: operation object to apply; must have "do" and "redo" methods
         """
         self.done.append(op)
-        self.undone = []
+        if self.undone:
+            self.undone.clear()
         return op.do()
     
     def undo(self):
@@ -82,21 +416,83 @@ class RegeneratingUndoStack(UndoStack):
     
     Return values from the operations pushed to the undo stack are discarded.
     
+    To bound the cost of an undo, a copy of the state is kept as a checkpoint
+    every `checkpoint_interval` operations, and the current state is rebuilt
+    from the most recent checkpoint rather than from the initial state.
+    
+    If an operation also has an "undo" method, which accepts the same argument
+    and exactly reverses the operation, undoing it simply calls that method
+    instead of rebuilding the current state.
+    
     This undo stack must hold references to the object or objects its
     operations are modifying. Exterior references to these objects may become
     stale during use, so all access to these objects should be carried out
     through this undo stack object, via its `current_state` variable.
+    
+    If the initial state is a plain NumPy array (not a subclass such as a
+    masked array, nor of object dtype), `current_state` is a single buffer
+    which is rebuilt in place with `numpy.copyto`, so references to it stay
+    valid. For the best performance, the operations should then be functions
+    compiled with `numba.njit` which modify the array they're given in place.
     """
-    def __init__(self, initial_state):
+    __slots__ = ('done', 'undone', '_current_state', 'initial_state',
+                 '_cow_shared', '_checkpoint_interval', '_checkpoints',
+                 '_np_mode')
+    
+    def __init__(self, initial_state, checkpoint_interval=16):
         """Creates a new RegeneratingUndoStack.
         
         Arguments:
             initial_state: objects to apply operations to
+            checkpoint_interval (int): number of operations between
+                                       checkpoints; 0 or None disables them
+        
+        Raises:
+            ValueError: if `checkpoint_interval` is negative or not an integer
         """
-        self.current_state = copy.deepcopy(initial_state)
-        self.initial_state = copy.deepcopy(initial_state)
-        self.done = []
-        self.undone = []
+        if checkpoint_interval is not None and (
+                isinstance(checkpoint_interval, bool)
+                or not isinstance(checkpoint_interval, numbers.Integral)
+                or checkpoint_interval < 0):
+            raise ValueError('checkpoint_interval must be a non-negative '
+                             'integer or None')
+        # subclasses (e.g. masked arrays) carry more than the data buffer, and
+        # object arrays hold references, which must be copied too
+        self._np_mode = (np is not None
+                         and type(initial_state) is np.ndarray
+                         and not initial_state.dtype.hasobject)
+        if self._np_mode:
+            self.initial_state = initial_state.copy(order='K')
+            self._current_state = initial_state.copy(order='K')
+            self._cow_shared = False
+        else:
+            if _is_immutable(initial_state):
+                self.initial_state = initial_state
+            else:
+                self.initial_state = _fast_deepcopy(initial_state)
+            self._current_state = self.initial_state
+            self._cow_shared = True
+        self.done = collections.deque()
+        self.undone = collections.deque()
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoints = []
+    
+    @property
+    def current_state(self):
+        """The state produced by applying the undo stack's operations.
+        
+        It may share an object with the initial state or a checkpoint, in which
+        case it is copied before being handed out.
+        """
+        if self._cow_shared:
+            self._current_state = _fast_deepcopy(self._current_state)
+            self._cow_shared = False
+        return self._current_state
+    
+    @current_state.setter
+    def current_state(self, state):
+        self._current_state = state
+        self._cow_shared = False
     
     def do(self, op):
         """Adds `op` to undo stack and applies it.
@@ -107,34 +503,76 @@ class RegeneratingUndoStack(UndoStack):
             op (callable): operation to apply; must take 1 positional argument
         """
         self.done.append(op)
-        self.undone = []
+        if self.undone:
+            self.undone.clear()
         op(self.current_state)
+        self._checkpoint()
     
-    def undo(self):
-        """Reverts the last undo stack operation and adds to redo stack.
+    def undo(self, n=1):
+        """Reverts the last `n` undo stack operations and adds to redo stack.
         
-        Does this by re-applying all but the last undo stack operation to the
-        initial state.
+        Does this by calling the operations' "undo" methods, if they have them,
+        or else by re-applying all but the last `n` undo stack operations to
+        the most recent checkpoint (or the initial state, if there is none).
+        The current state is rebuilt at most once, however large `n` is.
+        
+        Arguments:
+            n (int): number of operations to revert
         
         Raises:
-            IndexError: if the undo stack is empty.
+            IndexError: if the undo stack has fewer than `n` operations.
+            ValueError: if `n` is less than 1.
         """
-        self.undone.append(self.done.pop())
-        self._regenerate()
+        _check_steps(n, self.done)
+        regenerate = False
+        for _ in range(n):
+            op = self.done.pop()
+            self.undone.append(op)
+            if not regenerate and hasattr(op, 'undo'):
+                op.undo(self.current_state)
+            else:
+                regenerate = True
+        while self._checkpoints and self._checkpoints[-1][0] > len(self.done):
+            self._checkpoints.pop()
+        if regenerate:
+            self._regenerate()
     
-    def redo(self):
-        """Applies top redo stack operation and adds to undo stack.
+    def redo(self, n=1):
+        """Applies top `n` redo stack operations and adds to undo stack.
+        
+        Arguments:
+            n (int): number of operations to re-apply
         
         Raises:
-            IndexError: if the redo stack is empty.
+            IndexError: if the redo stack has fewer than `n` operations.
+            ValueError: if `n` is less than 1.
         """
-        op = self.undone.pop()
-        self.done.append(op)
-        op(self.current_state)
+        _check_steps(n, self.undone)
+        for _ in range(n):
+            op = self.undone.pop()
+            self.done.append(op)
+            op(self.current_state)
+            self._checkpoint()
+    
+    def _checkpoint(self):
+        interval = self._checkpoint_interval
+        if interval and len(self.done) % interval == 0:
+            # copy, so that existing references to current_state stay valid
+            self._checkpoints.append((len(self.done),
+                                      _fast_deepcopy(self._current_state)))
     
     def _regenerate(self):
-        self.current_state = copy.deepcopy(self.initial_state)
-        [op(self.current_state) for op in self.done]
+        if self._checkpoints:
+            start, state = self._checkpoints[-1]
+        else:
+            start, state = 0, self.initial_state
+        if self._np_mode:
+            np.copyto(self._current_state, state)
+        else:
+            self._current_state = state
+            self._cow_shared = True
+        for op in itertools.islice(self.done, start, None):
+            op(self.current_state)
 
 class SnapshotUndoStack(UndoStack):
     """Undo stack which is state-focused rather than operation-focused.
@@ -150,17 +588,135 @@ class SnapshotUndoStack(UndoStack):
     is taking snapshots. Exterior references to these objects may become
     stale during use, so all access to these objects should be carried out
     through this undo stack object, via its `current_state` variable.
+    
+    A snapshot restored by `undo`, `redo`, or `discard_changes` is shared with
+    `current_state` rather than copied, and a copy is only made the next time
+    `current_state` is accessed. Likewise, `do` only copies `current_state` if
+    it has been accessed since it was last restored or snapshotted.
+    
+    With the "persistent" backend, the state is converted to persistent
+    (immutable) collections from the `pyrsistent` package, and snapshots share
+    structure with one another instead of being copied at all. Changes are
+    then made by assigning or passing the new versions returned by, e.g.,
+    `current_state.set(i, v)` or `current_state.append(v)`; anything stored
+    inside the state must itself be immutable.
+    
+    With `diff` enabled, `snapshots` and `forward_snapshots` hold deltas
+    between consecutive states rather than the states themselves, and only the
+    most recent snapshot is kept in full. This saves a great deal of memory
+    when small changes are made to a large list or dict.
+    
+    If `max_history` is given, only that many snapshots are kept; taking
+    another discards the oldest, which then becomes the initial state.
+    
+    If `serialize` and `deserialize` functions are given, each snapshot is
+    stored as whatever `serialize` returns - e.g., a compact byte string from
+    `functools.partial(pickle.dumps, protocol=pickle.HIGHEST_PROTOCOL)` and
+    `pickle.loads` - rather than as a graph of live Python objects, which
+    eases pressure on the garbage collector when snapshots are large.
     """
-    def __init__(self, objects):
+    __slots__ = ('snapshots', 'forward_snapshots', '_current_state',
+                 'initial_state', '_cow_shared', '_committed', '_persistent',
+                 '_clone', '_diff', '_serialize', '_deserialize',
+                 '_version_counter', '_committed_version', '_current_version')
+    
+    def __init__(self, objects, backend=None, diff=False, max_history=None,
+                 serialize=None, deserialize=None):
         """Creates a new SnapshotUndoStack object.
         
         Arguments:
             objects: object or objects to take snapshots of
+            backend (str): None, or "persistent" to store the state in
+                           persistent collections (requires `pyrsistent`)
+            diff (bool): whether to store deltas between snapshots rather
+                         than the snapshots themselves
+            max_history (int): maximum number of snapshots to keep, or None
+                               for no limit
+            serialize (callable): if given, converts each state to the form
+                                  in which it is stored as a snapshot
+            deserialize (callable): inverse of `serialize`
+        
+        Raises:
+            ValueError: if `backend` is not recognized, or is combined with
+                        `diff`; if `max_history` is less than 1; or if only
+                        one of `serialize` and `deserialize` is given, or
+                        they are combined with `backend` or `diff`
+            ImportError: if the "persistent" backend is requested but
+                         `pyrsistent` is not installed
         """
-        self.snapshots = []
-        self.forward_snapshots = []
-        self.current_state = copy.deepcopy(objects)
-        self.initial_state = copy.deepcopy(objects)
+        if backend is None:
+            self._persistent = False
+            self._clone = _fast_deepcopy
+        elif backend == 'persistent':
+            if pyrsistent is None:
+                raise ImportError('the "persistent" backend requires '
+                                  'pyrsistent')
+            if diff:
+                raise ValueError('the "persistent" backend cannot be '
+                                 'combined with diff')
+            self._persistent = True
+            self._clone = _freeze
+        else:
+            raise ValueError('unknown backend: {!r}'.format(backend))
+        if max_history is not None and max_history < 1:
+            raise ValueError('max_history must be at least 1')
+        if (serialize is None) != (deserialize is None):
+            raise ValueError('serialize and deserialize must be given '
+                             'together')
+        if serialize is not None and (backend is not None or diff):
+            raise ValueError('serialize cannot be combined with backend or '
+                             'diff')
+        self._diff = diff
+        self._serialize = serialize
+        self._deserialize = deserialize
+        self.snapshots = collections.deque(maxlen=max_history)
+        self.forward_snapshots = collections.deque(maxlen=max_history)
+        if _is_immutable(objects) and not self._persistent:
+            self.initial_state = objects
+        else:
+            self.initial_state = self._clone(objects)
+        self._committed = self.initial_state
+        self._current_state = self.initial_state
+        self._cow_shared = True
+        # each committed state is stamped with a new version id, which
+        # `current_state` shares until it is handed out (and so may change)
+        self._version_counter = 0
+        self._committed_version = 0
+        self._current_version = 0
+    
+    @property
+    def current_state(self):
+        """The working state, which may differ from the last snapshot.
+        
+        If it is still shared with a snapshot, it is copied before being handed
+        out, so that changes made through it don't corrupt the snapshot.
+        """
+        if self._cow_shared:
+            self._current_state = self._clone(self._current_state)
+            self._cow_shared = False
+        if not self._persistent:
+            self._current_version = None
+        return self._current_state
+    
+    @current_state.setter
+    def current_state(self, state):
+        if self._persistent:
+            state = _freeze(state)
+        self._current_state = state
+        self._cow_shared = False
+        self._current_version = None
+    
+    @property
+    def lazy_state(self):
+        """Proxy for `current_state` which defers copying it until changed.
+        
+        Reading `current_state` copies it if it is shared with a snapshot, in
+        case the caller goes on to modify it. Reading through this proxy
+        instead costs nothing, so use it to inspect states while moving
+        through the undo history. Other methods (e.g., `append`,
+        `__setitem__`, `update`) are applied to `current_state` proper.
+        """
+        return _LazyCopy(self)
     
     def do(self, new_state=None):
         """Take a snapshot of some objects and add it to the undo stack.
@@ -175,52 +731,124 @@ class SnapshotUndoStack(UndoStack):
         """
         if new_state is not None:
             self.current_state = new_state
-        self.snapshots.append(copy.deepcopy(self.current_state))
-        self.forward_snapshots = []
+        if self._cow_shared:
+            # nobody else holds a reference, so it's safe to share
+            state = self._current_state
+        else:
+            state = self._clone(self._current_state)
+        if len(self.snapshots) == self.snapshots.maxlen:
+            self._drop_oldest()
+        if self._diff:
+            self.snapshots.append(_diff(self._committed, state))
+        elif self._serialize is not None:
+            self.snapshots.append(self._serialize(state))
+        else:
+            self.snapshots.append(state)
+        self._committed = state
+        self._new_version()
+        if self._cow_shared or self._persistent:
+            self._current_version = self._committed_version
+        if self.forward_snapshots:
+            self.forward_snapshots.clear()
     
-    def undo(self):
-        """Adds the last snapshot to redo stack and reverts to the one before.
+    def undo(self, n=1):
+        """Adds the last `n` snapshots to redo stack and reverts to the prior.
         
         If current_state contains changes not in the last snapshot, those are
-        discarded too.
+        discarded too. Only the snapshot finally reverted to is restored, so
+        undoing several steps at once is cheaper than undoing them one by one.
+        
+        Arguments:
+            n (int): number of snapshots to step back
         
         Raises:
-            IndexError: if the undo stack is empty
+            IndexError: if the undo stack has fewer than `n` snapshots
+            ValueError: if `n` is less than 1
         """
-        self.forward_snapshots.append(self.snapshots.pop())
-        if self.snapshots:
-            self.current_state = copy.deepcopy(self.snapshots[-1])
-        else:
-            self.current_state = copy.deepcopy(self.initial_state)
+        _check_steps(n, self.snapshots)
+        for _ in range(n):
+            snapshot = self.snapshots.pop()
+            self.forward_snapshots.append(snapshot)
+            if self._diff:
+                self._patch(snapshot, reverse=True)
+        if not self._diff:
+            if self.snapshots:
+                self._committed = self._load(self.snapshots[-1])
+            else:
+                self._committed = self.initial_state
+        self._new_version()
+        self._revert()
     
-    def redo(self):
-        """Adds the next snapshot to the undo stack and assumes its values.
+    def redo(self, n=1):
+        """Adds the next `n` snapshots to the undo stack and assumes the last.
         
         If current_state contains changes not in the last snapshot, they are
         lost.
         
+        Arguments:
+            n (int): number of snapshots to step forward
+        
         Raises:
-            IndexError: if the redo stack is empty.
+            IndexError: if the redo stack has fewer than `n` snapshots.
+            ValueError: if `n` is less than 1.
         """
-        self.snapshots.append(self.forward_snapshots.pop())
-        self.current_state = copy.deepcopy(self.snapshots[-1])
+        _check_steps(n, self.forward_snapshots)
+        for _ in range(n):
+            snapshot = self.forward_snapshots.pop()
+            self.snapshots.append(snapshot)
+            if self._diff:
+                self._patch(snapshot)
+        if not self._diff:
+            self._committed = self._load(snapshot)
+        self._new_version()
+        self._revert()
     
     @property
     def clean(self):
         """Checks whether `current_state` matches the last snapshot.
         
+        Only compares the states' contents if `current_state` has been handed
+        out (and so may have changed) since the last snapshot was taken or
+        restored.
+        
         Returns:
             bool: whether `current_state` matches the last snapshot.
         """
-        if self.snapshots:
-            return self.current_state == self.snapshots[-1]
-        else:
-            return self.current_state == self.initial_state
+        if self._current_version is not None:
+            return self._current_version == self._committed_version
+        return self._current_state == self._committed
     
     def discard_changes(self):
         """Discards any unrecorded changes to `current_state`."""
         if not self.clean:
-            if self.snapshots:
-                self.current_state = copy.deepcopy(self.snapshots[-1])
-            else:
-                self.current_state = copy.deepcopy(self.initial_state)
+            self._revert()
+    
+    def _drop_oldest(self):
+        oldest = self.snapshots.popleft()
+        if self._diff:
+            if (self.initial_state is self._committed
+                    or self.initial_state is self._current_state):
+                self.initial_state = self._clone(self.initial_state)
+            self.initial_state = _apply_delta(self.initial_state, oldest)
+        else:
+            self.initial_state = self._load(oldest)
+    
+    def _load(self, snapshot):
+        if self._deserialize is None:
+            return snapshot
+        return self._deserialize(snapshot)
+    
+    def _patch(self, delta, reverse=False):
+        # deltas are applied in place, and initial_state must not change
+        if self._committed is self.initial_state:
+            self._committed = self._clone(self._committed)
+        self._committed = _apply_delta(self._committed, delta, reverse)
+    
+    def _new_version(self):
+        self._version_counter += 1
+        self._committed_version = self._version_counter
+    
+    def _revert(self):
+        self._current_state = self._committed
+        self._cow_shared = True
+        self._current_version = self._committed_version